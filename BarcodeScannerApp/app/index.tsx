@@ -44,18 +44,29 @@ export default function CollectionScreen() {
     if (!headers) return;
 
     try {
-      const response = await fetch(`${API_URL}/sets`, {
-        method: "GET",
-        headers,
-      });
+      // The API returns the collection in pages; follow next_after to the end.
+      const allSets: LegoSet[] = [];
+      let after: number | null = null;
+      do {
+        const query: string = after === null ? "" : `?after=${after}`;
+        const response = await fetch(`${API_URL}/sets${query}`, {
+          method: "GET",
+          headers,
+        });
+
+        if (response.status === 401) {
+          Alert.alert("Session Expired", "Please sign in again");
+          await supabase.auth.signOut();
+          return;
+        }
+        if (!response.ok) return;
 
-      if (response.ok) {
         const data = await response.json();
-        setSets(data.sets || []);
-      } else if (response.status === 401) {
-        Alert.alert("Session Expired", "Please sign in again");
-        await supabase.auth.signOut();
-      }
+        allSets.push(...(data.sets || []));
+        after = data.next_after ?? null;
+      } while (after !== null);
+
+      setSets(allSets);
     } catch (error) {
       console.error("Error fetching sets:", error);
       Alert.alert("Error", "Failed to connect to API");
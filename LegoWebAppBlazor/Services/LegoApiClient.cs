@@ -11,17 +11,22 @@ public class LegoApiClient(HttpClient http)
     private readonly HttpClient _http = http;
 
     /// GET /sets — returns all LEGO sets for the authenticated user.
+    /// The API pages the collection, so keep following next_after until it is null.
     public async Task<List<LegoSetDto>> GetSetsAsync(string jwt)
     {
-       var request = new HttpRequestMessage(HttpMethod.Get, "/sets");
-       // Add the JWT to the Authorization header
-       request.Headers.Authorization = new AuthenticationHeaderValue("Bearer", jwt);
-
-       var response = await _http.SendAsync(request);
-
        List<LegoSetDto> sets = [];
-       if (response.IsSuccessStatusCode)
+       int? after = null;
+       do
        {
+           var url = after is null ? "/sets" : $"/sets?after={after}";
+           var request = new HttpRequestMessage(HttpMethod.Get, url);
+           // Add the JWT to the Authorization header
+           request.Headers.Authorization = new AuthenticationHeaderValue("Bearer", jwt);
+
+           var response = await _http.SendAsync(request);
+           if (!response.IsSuccessStatusCode)
+               break;
+
            var json = await response.Content.ReadFromJsonAsync<JsonElement>();
            foreach (var item in json.GetProperty("sets").EnumerateArray())
            {
@@ -29,7 +34,11 @@ public class LegoApiClient(HttpClient http)
                string name = item.GetProperty("name").GetString() ?? "";
                sets.Add(new LegoSetDto(setNumber, name));
            }
-       }
+
+           after = json.TryGetProperty("next_after", out var next) && next.ValueKind == JsonValueKind.Number
+               ? next.GetInt32()
+               : null;
+       } while (after is not null);
 
         return sets;
     }
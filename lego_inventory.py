@@ -1,15 +1,26 @@
 import uuid
-from sqlalchemy import create_engine, select, delete, Uuid, UniqueConstraint
-from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, Session
-from sqlalchemy.exc import IntegrityError
-from fastapi import FastAPI, HTTPException, Depends
+from sqlalchemy import bindparam, event, select, delete, func, make_url, URL, Uuid, UniqueConstraint
+from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column
+from sqlalchemy.pool import NullPool
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
+from fastapi import FastAPI, HTTPException, Depends, Query, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from jose import jwt, JWTError
+from pydantic import BaseModel, Field
+import jwt
+from jwt import InvalidTokenError, PyJWTError
 from dotenv import load_dotenv
+from cachetools import TTLCache
+from collections.abc import AsyncIterator
+from contextlib import asynccontextmanager
+import asyncio
+import httpx
+import orjson
 import os
-import json
-from urllib import request, error as urlerror
+import hashlib
+import re
+import time
 
 # Always load .env from this file's directory so running uvicorn from a
 # different working directory still picks up local configuration.
@@ -19,6 +30,11 @@ DATABASE_URL = os.getenv("DATABASE_URL", "")
 SUPABASE_JWT_SECRET = os.getenv("SUPABASE_JWT_SECRET", "")
 SUPABASE_URL = os.getenv("SUPABASE_URL", "")
 SUPABASE_ANON_KEY = os.getenv("SUPABASE_ANON_KEY", "")
+# Upper bound on how long a verified token is trusted without re-checking it.
+# Kept short so a revoked session stops working quickly.
+TOKEN_CACHE_TTL = int(os.getenv("TOKEN_CACHE_TTL", "30"))
+# Set when DATABASE_URL points at PgBouncer in transaction-pooling mode.
+DB_PGBOUNCER = os.getenv("DB_PGBOUNCER", "").lower() in ("1", "true", "yes")
 
 if not DATABASE_URL:
     raise RuntimeError("DATABASE_URL is not set")
@@ -30,21 +46,134 @@ class Base(DeclarativeBase):
 
 class LegoSet(Base):
     __tablename__ = "lego_sets"
-    __table_args__ = (UniqueConstraint("user_id", "set_number"),)
+    # Every query filters on user_id and orders by set_number; the unique
+    # constraint's (user_id, set_number) btree serves both, so set_number
+    # needs no index of its own.
+    # sqlite_autoincrement stops SQLite reusing the highest deleted id, which
+    # the GET /sets ETag relies on (Postgres sequences never reuse ids).
+    __table_args__ = (
+        UniqueConstraint("user_id", "set_number"),
+        {"sqlite_autoincrement": True},
+    )
 
     id: Mapped[int] = mapped_column(primary_key=True)
     user_id: Mapped[uuid.UUID] = mapped_column(Uuid)
-    set_number: Mapped[int] = mapped_column(index=True)
+    set_number: Mapped[int]
     name: Mapped[str]
 
 class CannotRemoveError(Exception):
     pass
 
-engine = create_engine(DATABASE_URL, echo=False)
+# --- Request Schemas ---
+
+class SetIn(BaseModel):
+    set_number: int
+    set_name: str
+
+class BulkSetsIn(BaseModel):
+    # Caps the request body size and the work a single request can queue up;
+    # larger restores are split across several calls.
+    sets: list[SetIn] = Field(max_length=1000)
+
+def _engine_options(url: str, pgbouncer: bool = False) -> dict:
+    # SQLite (tests / local dev) uses a single-connection pool that rejects
+    # QueuePool sizing arguments, so only tune the pool for real servers.
+    if make_url(url).get_backend_name() == "sqlite":
+        return {}
+    if pgbouncer:
+        # PgBouncer owns pooling, so hold no connections here. Transaction
+        # pooling hands each transaction a different backend, so asyncpg must
+        # not cache prepared statements or reuse their names across them.
+        return {
+            "poolclass": NullPool,
+            "connect_args": {
+                "statement_cache_size": 0,
+                "prepared_statement_cache_size": 0,
+                "prepared_statement_name_func": lambda: f"__asyncpg_{uuid.uuid4()}__",
+            },
+        }
+    # Every worker process builds its own pool, so split one connection budget
+    # across them; adding workers must not multiply connections to Postgres.
+    workers = max(int(os.getenv("WEB_CONCURRENCY", "1")), 1)
+    per_worker = max(int(os.getenv("DB_MAX_CONNECTIONS", "30")) // workers, 1)
+    pool_size = min(int(os.getenv("DB_POOL_SIZE", "20")), per_worker)
+    max_overflow = min(int(os.getenv("DB_MAX_OVERFLOW", "10")), per_worker - pool_size)
+    return {
+        "pool_size": pool_size,
+        "max_overflow": max_overflow,
+        "pool_timeout": int(os.getenv("DB_POOL_TIMEOUT", "30")),
+        "pool_recycle": int(os.getenv("DB_POOL_RECYCLE", "1800")),
+        # Supabase/Postgres drops idle connections; ping before handing one out
+        # instead of failing the request with a stale socket.
+        "pool_pre_ping": True,
+    }
+
+def _async_url(url: str) -> URL:
+    """Point a plain DATABASE_URL at the asyncio driver for its backend."""
+    parsed = make_url(url)
+    backend = parsed.get_backend_name()
+    if backend == "postgresql":
+        parsed = parsed.set(drivername="postgresql+asyncpg")
+        # asyncpg has no libpq-style sslmode; it takes the same values as ssl.
+        if "sslmode" in parsed.query:
+            query = dict(parsed.query)
+            query["ssl"] = query.pop("sslmode")
+            parsed = parsed.set(query=query)
+    elif backend == "sqlite":
+        parsed = parsed.set(drivername="sqlite+aiosqlite")
+    return parsed
+
+def _set_sqlite_pragmas(dbapi_connection, _):
+    # Local dev / tests on SQLite: WAL lets readers run alongside a writer and,
+    # with synchronous=NORMAL, avoids an fsync per commit.
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.execute("PRAGMA mmap_size=268435456")
+    cursor.close()
+
+engine = create_async_engine(
+    _async_url(DATABASE_URL), echo=False, **_engine_options(DATABASE_URL, DB_PGBOUNCER)
+)
+
+if engine.dialect.name == "sqlite":
+    event.listen(engine.sync_engine, "connect", _set_sqlite_pragmas)
+
+# Endpoints build plain dicts from committed data, so there is nothing to gain
+# from expiring attributes after commit (which would re-SELECT on access) or
+# from flushing before every query.
+async_session = async_sessionmaker(engine, expire_on_commit=False, autoflush=False)
+
+async def get_db() -> AsyncIterator[AsyncSession]:
+    """One session per request; closing it rolls back anything left uncommitted."""
+    async with async_session() as session:
+        yield session
 
 # --- FastAPI App ---
 
-app = FastAPI()
+# Shared client for auth-server fallback verification. Reusing it keeps TLS
+# connections to Supabase alive instead of handshaking on every request.
+_supabase_http: httpx.AsyncClient | None = None
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global _supabase_http
+    if SUPABASE_URL and SUPABASE_ANON_KEY:
+        _supabase_http = httpx.AsyncClient(
+            base_url=SUPABASE_URL,
+            headers={"apikey": SUPABASE_ANON_KEY},
+            timeout=8.0,
+            limits=httpx.Limits(max_keepalive_connections=20, max_connections=40),
+        )
+    yield
+    if _supabase_http is not None:
+        await _supabase_http.aclose()
+        _supabase_http = None
+    # Each worker process owns its engine; close its pooled connections on exit.
+    await engine.dispose()
+
+app = FastAPI(lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -52,117 +181,333 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["ETag"],
 )
 
 # --- Auth ---
 
 security = HTTPBearer()
 
-def _verify_with_supabase_auth_server(token: str) -> uuid.UUID:
+_HS256_ALGORITHMS = ["HS256"]
+
+# Projects on Supabase's asymmetric signing keys verify tokens locally against
+# the published JWKS. The key set is fetched once and reused for an hour.
+_JWKS_ALGORITHMS = ["RS256", "ES256"]
+_jwks_client = (
+    jwt.PyJWKClient(
+        f"{SUPABASE_URL}/auth/v1/.well-known/jwks.json",
+        cache_keys=True,
+        lifespan=3600,
+        headers={"apikey": SUPABASE_ANON_KEY},
+    )
+    if SUPABASE_URL
+    else None
+)
+
+async def _verify_with_supabase_auth_server(token: str) -> uuid.UUID:
     if not SUPABASE_URL or not SUPABASE_ANON_KEY:
         raise HTTPException(
             status_code=500,
             detail="Missing SUPABASE_URL or SUPABASE_ANON_KEY for token verification",
         )
 
-    req = request.Request(
-        f"{SUPABASE_URL}/auth/v1/user",
-        headers={
-            "apikey": SUPABASE_ANON_KEY,
-            "Authorization": f"Bearer {token}",
-        },
-        method="GET",
-    )
+    if _supabase_http is None:
+        raise HTTPException(status_code=503, detail="Auth verification service unavailable")
 
     try:
-        with request.urlopen(req, timeout=8) as response:
-            payload = json.loads(response.read().decode("utf-8"))
-            user_id = payload.get("id")
-            if not user_id:
-                raise HTTPException(status_code=401, detail="Invalid token: no user ID")
-            return uuid.UUID(user_id)
-    except urlerror.HTTPError as e:
-        if e.code in (401, 403):
-            raise HTTPException(status_code=401, detail="Invalid or expired token")
+        response = await _supabase_http.get(
+            "/auth/v1/user",
+            headers={"Authorization": f"Bearer {token}"},
+        )
+    except httpx.HTTPError:
+        raise HTTPException(status_code=503, detail="Failed to verify token")
+
+    if response.status_code in (401, 403):
+        raise HTTPException(status_code=401, detail="Invalid or expired token")
+    if response.status_code != 200:
         raise HTTPException(status_code=503, detail="Auth verification service unavailable")
-    except (ValueError, json.JSONDecodeError, urlerror.URLError):
+
+    # Only the parsing steps sit inside try blocks; the 401 below is ordinary
+    # control flow, not something to route through an exception handler.
+    try:
+        payload = response.json()
+    except ValueError:
         raise HTTPException(status_code=503, detail="Failed to verify token")
 
+    user_id = payload.get("id") if isinstance(payload, dict) else None
+    if not isinstance(user_id, str) or not user_id:
+        raise HTTPException(status_code=401, detail="Invalid token: no user ID")
+
+    try:
+        return uuid.UUID(user_id)
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=503, detail="Failed to verify token")
+
+
+# sha256(token) -> (user_id, expires_at). Only touched from the event loop,
+# so no locking is needed.
+_token_cache: TTLCache = TTLCache(maxsize=10000, ttl=TOKEN_CACHE_TTL)
 
-def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)) -> uuid.UUID:
-    """Verify Supabase JWT and return the user UUID."""
-    token = credentials.credentials
+
+def _get_cached_user(key: bytes) -> uuid.UUID | None:
+    entry = _token_cache.get(key)
+    if entry is None:
+        return None
+    user_id, expires_at = entry
+    if expires_at <= time.time():
+        return None
+    return user_id
+
+
+def _cache_user(key: bytes, user_id: uuid.UUID, exp) -> None:
+    now = time.time()
+    expires_at = now + TOKEN_CACHE_TTL
+    # Never trust a token past its own expiry.
+    if isinstance(exp, (int, float)):
+        expires_at = min(expires_at, exp)
+    if expires_at <= now:
+        return
+    _token_cache[key] = (user_id, expires_at)
+
+
+# header.payload.signature, each base64url without padding. Anything else can
+# never verify, so it is rejected before any HMAC or auth-server round trip.
+_JWT_SHAPE = re.compile(r"[A-Za-z0-9_-]+\.[A-Za-z0-9_-]+\.[A-Za-z0-9_-]+")
+
+
+def _user_from_claims(payload: dict) -> tuple[uuid.UUID, int | None]:
+    user_id = payload.get("sub")
+    if not user_id:
+        raise HTTPException(status_code=401, detail="Invalid token: no user ID")
+    return uuid.UUID(user_id), payload.get("exp")
+
+
+async def _verify_token(token: str) -> tuple[uuid.UUID, int | None]:
+    """Verify a Supabase JWT and return the user UUID and its exp claim."""
+    try:
+        alg = jwt.get_unverified_header(token).get("alg")
+    except InvalidTokenError:
+        alg = None
 
     # Fast path for legacy HS256 projects where JWT secret is configured.
-    if SUPABASE_JWT_SECRET:
+    if alg == "HS256" and SUPABASE_JWT_SECRET:
         try:
             payload = jwt.decode(
                 token,
                 SUPABASE_JWT_SECRET,
-                algorithms=["HS256"],
+                algorithms=_HS256_ALGORITHMS,
                 audience="authenticated",
             )
-            user_id = payload.get("sub")
-            if not user_id:
-                raise HTTPException(status_code=401, detail="Invalid token: no user ID")
-            return uuid.UUID(user_id)
-        except (JWTError, ValueError):
-            # Fallback to auth server verification for projects using signing keys
-            # or if JWT secret config is stale.
+            return _user_from_claims(payload)
+        except (InvalidTokenError, ValueError):
+            # Fallback to auth server verification if JWT secret config is stale.
             pass
+    elif alg in _JWKS_ALGORITHMS and _jwks_client is not None:
+        try:
+            # A JWKS refresh is a blocking HTTPS fetch; keep it off the event loop.
+            signing_key = await asyncio.to_thread(_jwks_client.get_signing_key_from_jwt, token)
+            payload = jwt.decode(
+                token,
+                signing_key.key,
+                algorithms=_JWKS_ALGORITHMS,
+                audience="authenticated",
+            )
+            return _user_from_claims(payload)
+        except (PyJWTError, ValueError):
+            # Unknown kid or unreachable JWKS endpoint: let the auth server decide.
+            pass
+
+    user_id = await _verify_with_supabase_auth_server(token)
+    # The auth server has vouched for the token, so its claims can be read
+    # without checking the signature again.
+    try:
+        exp = jwt.decode(token, options={"verify_signature": False}).get("exp")
+    except InvalidTokenError:
+        exp = None
+    return user_id, exp
+
+
+async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)) -> uuid.UUID:
+    """Verify Supabase JWT and return the user UUID."""
+    token = credentials.credentials
+    if not _JWT_SHAPE.fullmatch(token):
+        raise HTTPException(status_code=401, detail="Invalid token")
+
+    key = hashlib.sha256(token.encode()).digest()
+
+    user_id = _get_cached_user(key)
+    if user_id is not None:
+        return user_id
+
+    user_id, exp = await _verify_token(token)
+    _cache_user(key, user_id, exp)
+    return user_id
+
+# --- Queries ---
+# Fixed-shape statements are built once here and bound per request, so the
+# hot paths skip rebuilding the expression and its compiled-cache key.
+
+_SET_STATS_STMT = select(func.count(), func.max(LegoSet.id)).where(
+    LegoSet.user_id == bindparam("user_id")
+)
+
+# Keyset pagination: each page is a bounded range scan of the
+# (user_id, set_number) index, starting after the previous page's last set.
+_LIST_SETS_STMT = (
+    select(LegoSet.set_number, LegoSet.name)
+    .where(LegoSet.user_id == bindparam("user_id"))
+    .order_by(LegoSet.set_number)
+    .limit(bindparam("limit"))
+    # Stream in batches rather than buffering every row up front.
+    .execution_options(yield_per=500)
+)
+
+_LIST_SETS_AFTER_STMT = _LIST_SETS_STMT.where(LegoSet.set_number > bindparam("after"))
+
+# Takes user_id / set_number / name parameters, one dict per row.
+_ADD_SET_STMT = (
+    pg_insert(LegoSet)
+    .on_conflict_do_nothing(index_elements=["user_id", "set_number"])
+    .returning(LegoSet.set_number)
+)
 
-    return _verify_with_supabase_auth_server(token)
+_REMOVE_SET_STMT = (
+    delete(LegoSet)
+    .where(
+        LegoSet.set_number == bindparam("set_number"),
+        LegoSet.user_id == bindparam("user_id"),
+    )
+    .returning(LegoSet.set_number)
+)
+
+_DELETE_ALL_SETS_STMT = delete(LegoSet).where(LegoSet.user_id == bindparam("user_id"))
 
 # --- Endpoints ---
 
+def _collection_etag(
+    user_id: uuid.UUID, count: int, max_id: int | None, after: int | None, limit: int
+) -> str:
+    # Rows are never updated, only inserted or deleted, and ids are never
+    # reused (Postgres sequence / SQLite AUTOINCREMENT). Under those
+    # conditions the row count plus the highest id changes whenever the
+    # collection does. The page bounds are mixed in so each page gets its own
+    # validator.
+    digest = hashlib.blake2b(
+        f"{user_id}:{count}:{max_id}:{after}:{limit}".encode(), digest_size=8
+    )
+    return f'"{digest.hexdigest()}"'
+
+
+def _etag_matches(if_none_match: str | None, etag: str) -> bool:
+    if not if_none_match:
+        return False
+    candidates = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+    return etag in candidates or "*" in candidates
+
+
 @app.get("/sets")
-def list_sets(user_id: uuid.UUID = Depends(get_current_user)):
-    with Session(engine) as session:
-        rows = (
-            session.execute(
-                select(LegoSet)
-                .where(LegoSet.user_id == user_id)
-                .order_by(LegoSet.set_number)
-            )
-            .scalars()
-            .all()
+async def list_sets(
+    request: Request,
+    after: int | None = None,
+    limit: int = Query(200, ge=1, le=1000),
+    user_id: uuid.UUID = Depends(get_current_user),
+    session: AsyncSession = Depends(get_db),
+):
+    # Answer repeat polls of an unchanged collection from a one-row aggregate.
+    count, max_id = (
+        await session.execute(_SET_STATS_STMT, {"user_id": user_id})
+    ).one()
+    headers = {
+        "ETag": _collection_etag(user_id, count, max_id, after, limit),
+        "Cache-Control": "private, no-cache",
+    }
+    if _etag_matches(request.headers.get("If-None-Match"), headers["ETag"]):
+        return Response(status_code=304, headers=headers)
+
+    # Only two columns are returned, so select them directly instead of
+    # building ORM objects.
+    if after is None:
+        rows = await session.stream(_LIST_SETS_STMT, {"user_id": user_id, "limit": limit})
+    else:
+        rows = await session.stream(
+            _LIST_SETS_AFTER_STMT, {"user_id": user_id, "after": after, "limit": limit}
         )
-        return {
-            "message": "Retrieved",
-            "sets": [{"set_number": r.set_number, "name": r.name} for r in rows],
-        }
+    sets = [{"set_number": sn, "name": n} async for sn, n in rows]
+    # A full page means there may be more; clients pass this back as ?after=.
+    next_after = sets[-1]["set_number"] if len(sets) == limit else None
+    # Collections can run to thousands of sets; encode with orjson rather
+    # than the stdlib json encoder Starlette would use for a dict.
+    return Response(
+        orjson.dumps({"message": "Retrieved", "sets": sets, "next_after": next_after}),
+        media_type="application/json",
+        headers=headers,
+    )
 
 @app.post("/sets")
-def add_set(set_number: int, set_name: str, user_id: uuid.UUID = Depends(get_current_user)):
-    with Session(engine) as session:
-        try:
-            new_set = LegoSet(user_id=user_id, set_number=set_number, name=set_name)
-            session.add(new_set)
-            session.commit()
-            return {"message": "Added", "set_number": set_number}
-        except IntegrityError:
-            session.rollback()
-            raise HTTPException(status_code=409, detail="Lego set already exists in collection.")
+async def add_set(
+    set_number: int,
+    set_name: str,
+    user_id: uuid.UUID = Depends(get_current_user),
+    session: AsyncSession = Depends(get_db),
+):
+    result = await session.execute(
+        _ADD_SET_STMT, {"user_id": user_id, "set_number": set_number, "name": set_name}
+    )
+    inserted = result.scalar_one_or_none()
+    await session.commit()
 
-@app.delete("/sets")
-def remove_set(set_number: int, user_id: uuid.UUID = Depends(get_current_user)):
-    with Session(engine) as session:
-        result = session.execute(
-            delete(LegoSet)
-            .where(LegoSet.set_number == set_number, LegoSet.user_id == user_id)
-            .returning(LegoSet.set_number)
+    if inserted is None:
+        raise HTTPException(status_code=409, detail="Lego set already exists in collection.")
+
+    return {"message": "Added", "set_number": set_number}
+
+@app.post("/sets/bulk")
+async def add_sets_bulk(
+    body: BulkSetsIn,
+    user_id: uuid.UUID = Depends(get_current_user),
+    session: AsyncSession = Depends(get_db),
+):
+    # Collapse repeats within the payload; the first name given wins.
+    rows = {}
+    for s in body.sets:
+        rows.setdefault(
+            s.set_number,
+            {"user_id": user_id, "set_number": s.set_number, "name": s.set_name},
         )
-        deleted = result.scalar_one_or_none()
-        session.commit()
+    if not rows:
+        return {"message": "Added", "inserted": 0, "skipped": 0}
+
+    result = await session.execute(_ADD_SET_STMT, list(rows.values()))
+    inserted = len(result.all())
+    await session.commit()
+    return {
+        "message": "Added",
+        "inserted": inserted,
+        "skipped": len(body.sets) - inserted,
+    }
+
+@app.delete("/sets")
+async def remove_set(
+    set_number: int,
+    user_id: uuid.UUID = Depends(get_current_user),
+    session: AsyncSession = Depends(get_db),
+):
+    result = await session.execute(
+        _REMOVE_SET_STMT, {"set_number": set_number, "user_id": user_id}
+    )
+    deleted = result.scalar_one_or_none()
+    await session.commit()
 
-        if deleted is None:
-            raise HTTPException(status_code=404, detail="Cannot remove provided set.")
+    if deleted is None:
+        raise HTTPException(status_code=404, detail="Cannot remove provided set.")
 
-        return {"message": "Deleted", "set_number": set_number}
+    return {"message": "Deleted", "set_number": set_number}
 
 @app.delete("/delete_sets")
-def delete_all_sets(user_id: uuid.UUID = Depends(get_current_user)):
-    with Session(engine) as session:
-        session.execute(delete(LegoSet).where(LegoSet.user_id == user_id))
-        session.commit()
-        return {"message": "Deleted all sets"}
+async def delete_all_sets(
+    user_id: uuid.UUID = Depends(get_current_user),
+    session: AsyncSession = Depends(get_db),
+):
+    await session.execute(_DELETE_ALL_SETS_STMT, {"user_id": user_id})
+    await session.commit()
+    return {"message": "Deleted all sets"}
@@ -2,18 +2,22 @@
 Shared fixtures and helpers for all test modules.
 
 The DATABASE_URL env var must be set before lego_inventory is imported so the
-module-level create_engine() call picks up SQLite instead of PostgreSQL.  We do
+module-level create_async_engine() call picks up SQLite (via aiosqlite) instead
+of PostgreSQL.  We do
 that here, at import time of conftest, which pytest processes before any test
 module is collected.
 """
 
+import asyncio
 import os
 import uuid
 
+import httpx
 import pytest
 from dotenv import load_dotenv
-from jose import jwt
-from sqlalchemy import create_engine
+import jwt
+from sqlalchemy import event, inspect as sa_inspect
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
 from sqlalchemy.pool import StaticPool
 from fastapi.testclient import TestClient
 
@@ -42,26 +46,89 @@ def make_token(user_id=None, secret: str = TEST_JWT_SECRET, extra_claims=None) -
     return jwt.encode(payload, secret, algorithm="HS256")
 
 
+def inspect_db(engine, fn):
+    """Call ``fn`` with a synchronous SQLAlchemy inspector for an async engine."""
+    async def _inspect():
+        async with engine.connect() as conn:
+            return await conn.run_sync(lambda sync_conn: fn(sa_inspect(sync_conn)))
+    return asyncio.run(_inspect())
+
+
 # ── fixtures ───────────────────────────────────────────────────────────────
 
-@pytest.fixture()
-def db_engine(monkeypatch):
-    """Fresh in-memory SQLite database, wired into the app for the duration of one test."""
-    engine = create_engine(
-        "sqlite:///:memory:",
+@pytest.fixture(scope="session")
+def db_engine():
+    """In-memory SQLite database whose schema is built once for the whole run."""
+    engine = create_async_engine(
+        "sqlite+aiosqlite:///:memory:",
         connect_args={"check_same_thread": False},
         poolclass=StaticPool,
     )
-    Base.metadata.create_all(engine)
-    monkeypatch.setattr(app_module, "engine", engine)
+
+    event.listen(engine.sync_engine, "connect", app_module._set_sqlite_pragmas)
+
+    # The sqlite3 driver manages transactions itself and does not nest
+    # SAVEPOINTs inside them; take over so db_session's rollback holds.
+    @event.listens_for(engine.sync_engine, "connect")
+    def _disable_driver_transactions(dbapi_connection, _):
+        dbapi_connection.isolation_level = None
+
+    @event.listens_for(engine.sync_engine, "begin")
+    def _emit_begin(conn):
+        conn.exec_driver_sql("BEGIN")
+
+    async def _create():
+        async with engine.begin() as conn:
+            await conn.run_sync(Base.metadata.create_all)
+
+    async def _drop():
+        async with engine.begin() as conn:
+            await conn.run_sync(Base.metadata.drop_all)
+        await engine.dispose()
+
+    asyncio.run(_create())
     yield engine
-    Base.metadata.drop_all(engine)
-    engine.dispose()
+    asyncio.run(_drop())
 
 
 @pytest.fixture()
-def client(db_engine):
-    """TestClient backed by the isolated SQLite database."""
+def db_session(db_engine):
+    """Session joined to an outer transaction that is rolled back after one test.
+
+    Endpoints get this session in place of ``get_db``; their commits only
+    release a SAVEPOINT, so every test sees an empty table without the schema
+    being rebuilt.
+    """
+    async def _open():
+        conn = await db_engine.connect()
+        trans = await conn.begin()
+        session = AsyncSession(
+            bind=conn,
+            join_transaction_mode="create_savepoint",
+            expire_on_commit=False,
+            autoflush=False,
+        )
+        return conn, trans, session
+
+    async def _close():
+        await session.close()
+        await trans.rollback()
+        await conn.close()
+
+    async def _get_db():
+        yield session
+
+    conn, trans, session = asyncio.run(_open())
+    app.dependency_overrides[app_module.get_db] = _get_db
+    yield session
+    app.dependency_overrides.pop(app_module.get_db, None)
+    asyncio.run(_close())
+
+
+@pytest.fixture()
+def client(db_session):
+    """TestClient backed by the per-test SQLite transaction."""
+    app_module._token_cache.clear()
     with TestClient(app, raise_server_exceptions=False) as c:
         yield c
 
@@ -80,3 +147,23 @@ def auth_headers():
     def _make(user_id=None) -> dict:
         return {"Authorization": f"Bearer {make_token(user_id)}"}
     return _make
+
+
+@pytest.fixture()
+def mock_auth_server(monkeypatch):
+    """Return a callable that points auth-server fallback at an httpx handler.
+
+    Usage::
+
+        def test_something(client, mock_auth_server):
+            mock_auth_server(lambda request: httpx.Response(401))
+    """
+    def _install(handler) -> None:
+        monkeypatch.setattr(app_module, "SUPABASE_URL", "https://project.supabase.co")
+        monkeypatch.setattr(app_module, "SUPABASE_ANON_KEY", "anon-key")
+        monkeypatch.setattr(app_module, "_supabase_http", httpx.AsyncClient(
+            base_url="https://project.supabase.co",
+            headers={"apikey": "anon-key"},
+            transport=httpx.MockTransport(handler),
+        ))
+    return _install
@@ -7,14 +7,21 @@ a FastAPI TestClient, so no real Supabase or PostgreSQL instance is required.
 Test node IDs match the entries recorded in .pytest_cache/v/cache/nodeids.
 """
 
+import asyncio
+import hashlib
+import time
 import uuid
 
+import httpx
+import jwt
 import pytest
-from jose import jwt
-from sqlalchemy import inspect as sa_inspect
+from cryptography.hazmat.primitives.asymmetric import ec
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy.pool import NullPool
 
 import lego_inventory as app_module
-from tests.conftest import TEST_JWT_SECRET, make_token
+from tests.conftest import TEST_JWT_SECRET, inspect_db, make_token
 
 
 # ── collection / add ───────────────────────────────────────────────────────
@@ -25,6 +32,65 @@ def test_list_sets_starts_empty_for_new_user(client, auth_headers):
     assert resp.json()["sets"] == []
 
 
+def test_list_sets_returns_json_body(client, auth_headers):
+    headers = auth_headers()
+    client.post("/sets", params={"set_number": 7, "set_name": "Tiny Set"}, headers=headers)
+
+    resp = client.get("/sets", headers=headers)
+    assert resp.headers["content-type"] == "application/json"
+    assert resp.json() == {
+        "message": "Retrieved",
+        "sets": [{"set_number": 7, "name": "Tiny Set"}],
+        "next_after": None,
+    }
+
+
+def test_list_sets_returns_304_when_etag_matches(client, auth_headers):
+    headers = auth_headers()
+    client.post("/sets", params={"set_number": 7, "set_name": "Tiny Set"}, headers=headers)
+
+    etag = client.get("/sets", headers=headers).headers["ETag"]
+    resp = client.get("/sets", headers={**headers, "If-None-Match": etag})
+    assert resp.status_code == 304
+    assert resp.content == b""
+    assert resp.headers["ETag"] == etag
+
+
+def test_list_sets_etag_changes_when_collection_changes(client, auth_headers):
+    headers = auth_headers()
+    client.post("/sets", params={"set_number": 7, "set_name": "Tiny Set"}, headers=headers)
+    etag = client.get("/sets", headers=headers).headers["ETag"]
+
+    client.post("/sets", params={"set_number": 8, "set_name": "Next Set"}, headers=headers)
+    resp = client.get("/sets", headers={**headers, "If-None-Match": etag})
+    assert resp.status_code == 200
+    assert resp.headers["ETag"] != etag
+
+    client.delete("/sets", params={"set_number": 7}, headers=headers)
+    assert client.get("/sets", headers=headers).headers["ETag"] != resp.headers["ETag"]
+
+
+def test_list_sets_etag_changes_when_highest_set_is_replaced(client, auth_headers):
+    headers = auth_headers()
+    for sn in [1, 2]:
+        client.post("/sets", params={"set_number": sn, "set_name": f"Set {sn}"}, headers=headers)
+    etag = client.get("/sets", headers=headers).headers["ETag"]
+
+    # Same row count afterwards; the new row must not reuse the deleted row's id.
+    client.delete("/sets", params={"set_number": 2}, headers=headers)
+    client.post("/sets", params={"set_number": 3, "set_name": "Set 3"}, headers=headers)
+
+    resp = client.get("/sets", headers={**headers, "If-None-Match": etag})
+    assert resp.status_code == 200
+    assert [s["set_number"] for s in resp.json()["sets"]] == [1, 3]
+
+
+def test_list_sets_etag_is_per_user(client, auth_headers):
+    etag_a = client.get("/sets", headers=auth_headers()).headers["ETag"]
+    etag_b = client.get("/sets", headers=auth_headers()).headers["ETag"]
+    assert etag_a != etag_b
+
+
 def test_add_set_returns_confirmation_with_set_number(client, auth_headers):
     headers = auth_headers()
     resp = client.post(
@@ -62,6 +128,104 @@ def test_add_set_validates_required_params(client, auth_headers):
     assert resp.status_code == 422
 
 
+# ── bulk add (POST /sets/bulk) ─────────────────────────────────────────────
+
+def test_bulk_add_inserts_new_sets_and_skips_existing(client, auth_headers):
+    headers = auth_headers()
+    client.post("/sets", params={"set_number": 10, "set_name": "Owned"}, headers=headers)
+
+    resp = client.post(
+        "/sets/bulk",
+        json={"sets": [
+            {"set_number": 10, "set_name": "Owned"},
+            {"set_number": 20, "set_name": "New"},
+            {"set_number": 30, "set_name": "Also New"},
+            {"set_number": 20, "set_name": "Repeated In Payload"},
+        ]},
+        headers=headers,
+    )
+    assert resp.status_code == 200
+    assert resp.json() == {"message": "Added", "inserted": 2, "skipped": 2}
+
+    sets = client.get("/sets", headers=headers).json()["sets"]
+    assert sets == [
+        {"set_number": 10, "name": "Owned"},
+        {"set_number": 20, "name": "New"},
+        {"set_number": 30, "name": "Also New"},
+    ]
+
+
+def test_bulk_add_does_not_conflict_with_other_users(client, auth_headers):
+    user_a = auth_headers()
+    user_b = auth_headers()
+    client.post("/sets", params={"set_number": 42, "set_name": "A's"}, headers=user_a)
+
+    resp = client.post(
+        "/sets/bulk", json={"sets": [{"set_number": 42, "set_name": "B's"}]}, headers=user_b
+    )
+    assert resp.json()["inserted"] == 1
+
+
+def test_bulk_add_accepts_empty_list(client, auth_headers):
+    resp = client.post("/sets/bulk", json={"sets": []}, headers=auth_headers())
+    assert resp.status_code == 200
+    assert resp.json() == {"message": "Added", "inserted": 0, "skipped": 0}
+
+
+# ── pagination ─────────────────────────────────────────────────────────────
+
+def test_list_sets_pages_through_large_collection(client, auth_headers):
+    headers = auth_headers()
+    numbers = list(range(1, 601))  # three default-size pages
+    client.post(
+        "/sets/bulk",
+        json={"sets": [{"set_number": n, "set_name": f"Set {n}"} for n in reversed(numbers)]},
+        headers=headers,
+    )
+
+    seen, params = [], {}
+    while True:
+        body = client.get("/sets", params=params, headers=headers).json()
+        assert len(body["sets"]) <= 200
+        seen += [s["set_number"] for s in body["sets"]]
+        if body["next_after"] is None:
+            break
+        params = {"after": body["next_after"]}
+    assert seen == numbers
+
+
+def test_list_sets_honours_limit_and_after(client, auth_headers):
+    headers = auth_headers()
+    for sn in [5, 10, 15, 20]:
+        client.post("/sets", params={"set_number": sn, "set_name": f"Set {sn}"}, headers=headers)
+
+    first = client.get("/sets", params={"limit": 2}, headers=headers).json()
+    assert [s["set_number"] for s in first["sets"]] == [5, 10]
+    assert first["next_after"] == 10
+
+    second = client.get("/sets", params={"limit": 2, "after": 10}, headers=headers).json()
+    assert [s["set_number"] for s in second["sets"]] == [15, 20]
+
+    last = client.get("/sets", params={"limit": 2, "after": 20}, headers=headers).json()
+    assert last == {"message": "Retrieved", "sets": [], "next_after": None}
+
+
+@pytest.mark.parametrize("limit", [0, 1001])
+def test_list_sets_rejects_out_of_range_limit(client, auth_headers, limit):
+    resp = client.get("/sets", params={"limit": limit}, headers=auth_headers())
+    assert resp.status_code == 422
+
+
+def test_list_sets_etag_differs_per_page(client, auth_headers):
+    headers = auth_headers()
+    for sn in [1, 2, 3]:
+        client.post("/sets", params={"set_number": sn, "set_name": f"Set {sn}"}, headers=headers)
+
+    first = client.get("/sets", params={"limit": 2}, headers=headers).headers["ETag"]
+    second = client.get("/sets", params={"limit": 2, "after": 2}, headers=headers).headers["ETag"]
+    assert first != second
+
+
 # ── user isolation ─────────────────────────────────────────────────────────
 
 def test_list_sets_is_scoped_to_authenticated_user(client, auth_headers):
@@ -123,6 +287,7 @@ def test_delete_all_sets_clears_only_current_users_collection(client, auth_heade
 @pytest.mark.parametrize("method,path", [
     ("get",    "/sets"),
     ("post",   "/sets"),
+    ("post",   "/sets/bulk"),
     ("delete", "/sets"),
     ("delete", "/delete_sets"),
 ])
@@ -141,6 +306,16 @@ def test_malformed_token_is_rejected(client, monkeypatch):
     assert resp.status_code in (401, 403, 500)
 
 
+@pytest.mark.parametrize("token", ["garbage", "a.b", "a..c", "a.b.c.d", "a.b.c=", "a.b.c d"])
+def test_non_jwt_token_is_rejected_without_auth_server_call(client, mock_auth_server, token):
+    calls = []
+    mock_auth_server(lambda request: calls.append(request) or httpx.Response(200))
+
+    resp = client.get("/sets", headers={"Authorization": f"Bearer {token}"})
+    assert resp.status_code == 401
+    assert calls == []
+
+
 def test_token_signed_with_wrong_secret_is_rejected(client, monkeypatch):
     monkeypatch.setattr(app_module, "SUPABASE_JWT_SECRET", TEST_JWT_SECRET)
     monkeypatch.setattr(app_module, "SUPABASE_URL", "")
@@ -148,7 +323,7 @@ def test_token_signed_with_wrong_secret_is_rejected(client, monkeypatch):
 
     bad_token = jwt.encode(
         {"sub": str(uuid.uuid4()), "aud": "authenticated"},
-        "completely-wrong-secret-value!!",
+        "completely-wrong-secret-value-32chars!!",
         algorithm="HS256",
     )
     resp = client.get("/sets", headers={"Authorization": f"Bearer {bad_token}"})
@@ -164,16 +339,174 @@ def test_token_missing_sub_claim_is_rejected(client, monkeypatch):
     assert resp.status_code == 401
 
 
+def test_auth_server_fallback_resolves_user(client, mock_auth_server):
+    user_id = uuid.uuid4()
+
+    def handler(request):
+        assert request.url.path == "/auth/v1/user"
+        assert request.headers["apikey"] == "anon-key"
+        return httpx.Response(200, json={"id": str(user_id)})
+
+    mock_auth_server(handler)
+
+    token = make_token(user_id, secret="signed-with-new-signing-key-32chars!")
+    headers = {"Authorization": f"Bearer {token}"}
+    client.post("/sets", params={"set_number": 5, "set_name": "Fallback"}, headers=headers)
+    resp = client.get("/sets", headers=headers)
+    assert resp.status_code == 200
+    assert [s["set_number"] for s in resp.json()["sets"]] == [5]
+
+
+def test_auth_server_rejection_returns_401(client, mock_auth_server):
+    mock_auth_server(lambda request: httpx.Response(401))
+
+    token = make_token(secret="signed-with-new-signing-key-32chars!")
+    resp = client.get("/sets", headers={"Authorization": f"Bearer {token}"})
+    assert resp.status_code == 401
+
+
+@pytest.mark.parametrize("payload,expected", [
+    ([], 401),               # JSON, but not an object
+    ({"id": None}, 401),     # no user id
+    ({"id": 123}, 401),      # user id that is not a string
+    ({"id": "nope"}, 503),   # id that is not a UUID
+])
+def test_auth_server_unexpected_payload_is_handled(client, mock_auth_server, payload, expected):
+    mock_auth_server(lambda request: httpx.Response(200, json=payload))
+
+    token = make_token(secret="signed-with-new-signing-key-32chars!")
+    resp = client.get("/sets", headers={"Authorization": f"Bearer {token}"})
+    assert resp.status_code == expected
+
+
+def test_asymmetric_token_is_verified_against_cached_jwks(client, monkeypatch):
+    private_key = ec.generate_private_key(ec.SECP256R1())
+    public_jwk = jwt.algorithms.ECAlgorithm.to_jwk(private_key.public_key(), as_dict=True)
+    fetches = []
+
+    jwks_client = jwt.PyJWKClient("https://project.supabase.co/auth/v1/.well-known/jwks.json")
+    def fetch_data():
+        fetches.append(1)
+        return {"keys": [{**public_jwk, "kid": "key-1", "alg": "ES256", "use": "sig"}]}
+    monkeypatch.setattr(jwks_client, "fetch_data", fetch_data)
+    monkeypatch.setattr(app_module, "_jwks_client", jwks_client)
+    # No auth server configured: the token must be accepted locally.
+    monkeypatch.setattr(app_module, "SUPABASE_URL", "")
+
+    for _ in range(2):
+        token = jwt.encode(
+            {"sub": str(uuid.uuid4()), "aud": "authenticated"},
+            private_key,
+            algorithm="ES256",
+            headers={"kid": "key-1"},
+        )
+        resp = client.get("/sets", headers={"Authorization": f"Bearer {token}"})
+        assert resp.status_code == 200
+
+    assert len(fetches) == 1
+
+
+# ── token cache ───────────────────────────────────────────────────────────
+
+def test_verified_token_is_served_from_cache(client, monkeypatch):
+    token = make_token()
+    headers = {"Authorization": f"Bearer {token}"}
+    assert client.get("/sets", headers=headers).status_code == 200
+
+    # A cache hit must not re-run verification, so a rotated secret is not
+    # noticed until the entry expires.
+    monkeypatch.setattr(app_module, "SUPABASE_JWT_SECRET", "rotated-secret-that-is-32-chars!!")
+    monkeypatch.setattr(app_module, "SUPABASE_URL", "")
+    assert client.get("/sets", headers=headers).status_code == 200
+
+
+def test_token_is_not_cached_past_its_exp(client):
+    token = make_token(extra_claims={"exp": int(time.time()) + 1})
+    assert client.get("/sets", headers={"Authorization": f"Bearer {token}"}).status_code == 200
+
+    key = hashlib.sha256(token.encode()).digest()
+    _, expires_at = app_module._token_cache[key]
+    assert expires_at <= time.time() + 1
+
+
 # ── database constraint verification ──────────────────────────────────────
 
 def test_supabase_unique_constraint_exists(db_engine):
-    constraints = sa_inspect(db_engine).get_unique_constraints("lego_sets")
+    constraints = inspect_db(db_engine, lambda i: i.get_unique_constraints("lego_sets"))
     assert len(constraints) >= 1, "Expected at least one unique constraint on lego_sets"
 
 
 def test_supabase_unique_constraint_on_user_id_and_set_number(db_engine):
-    constraints = sa_inspect(db_engine).get_unique_constraints("lego_sets")
+    constraints = inspect_db(db_engine, lambda i: i.get_unique_constraints("lego_sets"))
     constraint_cols = {frozenset(c["column_names"]) for c in constraints}
     assert frozenset(["user_id", "set_number"]) in constraint_cols, (
         "Expected a unique constraint covering (user_id, set_number)"
     )
+
+
+def test_set_number_has_no_standalone_index(db_engine):
+    indexes = inspect_db(db_engine, lambda i: i.get_indexes("lego_sets"))
+    assert not any(ix["column_names"] == ["set_number"] for ix in indexes), (
+        "set_number is covered by the (user_id, set_number) unique index"
+    )
+
+
+# ── engine configuration ──────────────────────────────────────────────────
+
+def test_engine_options_tune_postgres_pool(monkeypatch):
+    monkeypatch.delenv("WEB_CONCURRENCY", raising=False)
+    monkeypatch.setenv("DB_POOL_SIZE", "7")
+    opts = app_module._engine_options("postgresql://user:pw@localhost/Legos")
+    assert opts["pool_size"] == 7
+    assert opts["pool_pre_ping"] is True
+
+
+def test_engine_options_split_connection_budget_across_workers(monkeypatch):
+    monkeypatch.setenv("WEB_CONCURRENCY", "8")
+    monkeypatch.setenv("DB_MAX_CONNECTIONS", "40")
+    opts = app_module._engine_options("postgresql://user:pw@localhost/Legos")
+    assert opts["pool_size"] + opts["max_overflow"] <= 40 // 8
+    assert opts["pool_size"] >= 1
+
+
+def test_engine_options_defer_pooling_to_pgbouncer():
+    opts = app_module._engine_options("postgresql://user:pw@pgbouncer:6432/Legos", pgbouncer=True)
+    assert opts["poolclass"] is NullPool
+    assert opts["connect_args"]["statement_cache_size"] == 0
+    name_func = opts["connect_args"]["prepared_statement_name_func"]
+    assert name_func() != name_func()
+
+
+def test_engine_options_skip_sqlite():
+    assert app_module._engine_options("sqlite:///:memory:") == {}
+
+
+def test_sessions_skip_expire_on_commit_and_autoflush():
+    assert app_module.async_session.kw["expire_on_commit"] is False
+    assert app_module.async_session.kw["autoflush"] is False
+
+
+def test_sqlite_pragmas_enable_wal(tmp_path):
+    engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path / 'dev.db'}")
+    event.listen(engine.sync_engine, "connect", app_module._set_sqlite_pragmas)
+
+    async def _pragmas():
+        async with engine.connect() as conn:
+            journal = (await conn.exec_driver_sql("PRAGMA journal_mode")).scalar()
+            synchronous = (await conn.exec_driver_sql("PRAGMA synchronous")).scalar()
+        await engine.dispose()
+        return journal, synchronous
+
+    assert asyncio.run(_pragmas()) == ("wal", 1)  # 1 == NORMAL
+
+
+def test_async_url_selects_asyncpg_and_translates_sslmode():
+    url = app_module._async_url("postgresql://user:pw@db.example.com:5432/Legos?sslmode=require")
+    assert url.drivername == "postgresql+asyncpg"
+    assert dict(url.query) == {"ssl": "require"}
+
+
+def test_async_url_selects_aiosqlite():
+    url = app_module._async_url("sqlite:///:memory:")
+    assert url.drivername == "sqlite+aiosqlite"
+    assert url.database == ":memory:"
@@ -21,8 +21,8 @@ import os
 import uuid
 
 import httpx
+import jwt
 import pytest
-from jose import jwt
 
 # ── configuration ──────────────────────────────────────────────────────────
 